@@ -2,13 +2,23 @@
 # app_streamlit_fema_water.py (enhanced)
 # Streamlit app: FEMA PA (v2) – Find wildfire-related funding to water utilities.
 import streamlit as st
+from st_aggrid import AgGrid, GridUpdateMode
 import requests
+import orjson
+import ijson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import urllib.parse
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Sequence, Tuple
 
 API_BASE = "https://www.fema.gov/api/open/v2/PublicAssistanceGrantAwardActivities"
+PAGE_SIZE = 1000
+MAX_WORKERS = 8
 
 DEFAULT_INCLUDE = [
     "water", "water district", "water dept", "water department", "water authority",
@@ -23,8 +33,22 @@ DEFAULT_EXCLUDE = [
 
 ALL_CATEGORIES = ["A","B","C","D","E","F","G"]
 
-def build_filter(states: Optional[List[str]], start: Optional[str], end: Optional[str],
-                 categories: List[str], incident_contains: bool) -> str:
+# Include lists up to this size are also pushed into $filter so the API only returns candidate rows.
+MAX_PUSHDOWN_TERMS = 8
+
+def _collapse_keywords(keywords: List[str]) -> List[str]:
+    # A keyword containing another keyword can never change an "any match" result
+    # ("water district" vs "water"), so drop it and keep the alternation short.
+    kept = []
+    for k in sorted(set(keywords), key=len):
+        if not any(j in k for j in kept):
+            kept.append(k)
+    return kept
+
+def build_filter(states: Sequence[str], start: Optional[str], end: Optional[str],
+                 categories: Sequence[str], incident_contains: bool,
+                 include: Optional[List[str]] = None) -> str:
+    # Expects states/categories already stripped and upper-cased by the caller.
     parts = []
     if incident_contains:
         parts.append("(substringof('Fire',incidentType) or substringof('Wildfire',incidentType))")
@@ -32,91 +56,177 @@ def build_filter(states: Optional[List[str]], start: Optional[str], end: Optiona
         parts.append("incidentType eq 'Fire'")
     
     if categories:
-        cat_or = " or ".join([f"damageCategoryCode eq '{c.strip().upper()}'" for c in categories if c.strip()])
-        if cat_or:
-            parts.append("(" + cat_or + ")")
-
+        parts.append("(" + " or ".join(f"damageCategoryCode eq '{c}'" for c in categories) + ")")
     if states:
-        state_filters = [f"stateAbbreviation eq '{s.strip().upper()}'" for s in states if s.strip()]
-        if state_filters:
-            parts.append("(" + " or ".join(state_filters) + ")")
+        parts.append("(" + " or ".join(f"stateAbbreviation eq '{s}'" for s in states) + ")")
     if start:
         parts.append(f"dateObligated ge '{start}'")
     if end:
         parts.append(f"dateObligated le '{end}'")
+    terms = _collapse_keywords(include or [])
+    # water_utility_mask matches against "name title", so a keyword containing a
+    # space could match across the two fields; the server checks each field on its
+    # own, so only push down when no term can span them. Exclusions stay Python-side.
+    if terms and len(terms) <= MAX_PUSHDOWN_TERMS and not any(" " in k for k in terms):
+        terms = [k.replace("'", "''") for k in terms]
+        kw_or = " or ".join(
+            f"substringof('{k}',tolower({field}))"
+            for k in terms for field in ("applicantName", "projectTitle")
+        )
+        parts.append("(" + kw_or + ")")
     return " and ".join(parts)
 
-def fetch_all(filters: str, select_fields: Optional[List[str]] = None, progress=None, debug=False) -> pd.DataFrame:
-    records = []
-    top = 1000
-    skip = 0
+@st.cache_resource
+def _session() -> requests.Session:
+    # Shared across reruns so keep-alive connections and TLS sessions to fema.gov are reused.
+    s = requests.Session()
+    s.headers.update({"Accept-Encoding": "gzip, deflate", "Accept": "application/json"})
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+    s.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry))
+    return s
+
+def fetch_all(filters: str, select_fields: Optional[List[str]] = None, debug=False) -> pd.DataFrame:
+    top = PAGE_SIZE
     base_params = {
         "$filter": filters,
         "$top": str(top),
-        "$skip": str(skip),
+        "$skip": "0",
         "$format": "json",
         "$count": "true"
     }
     if select_fields:
         base_params["$select"] = ",".join(select_fields)
-    session = requests.Session()
-    total_count = None
-    last_url = ""
-    while True:
+    session = _session()
+
+    def page_url(skip: int) -> str:
         params = dict(base_params)
         params["$skip"] = str(skip)
-        url = API_BASE + "?" + urllib.parse.urlencode(params, safe="(),':")
-        last_url = url
-        resp = session.get(url, timeout=60)
+        return API_BASE + "?" + urllib.parse.urlencode(params, safe="(),':")
+
+    def check(resp: requests.Response) -> None:
         if resp.status_code != 200:
             raise RuntimeError(f"HTTP {resp.status_code}: {resp.text[:500]}")
-        payload = resp.json()
-        data_key = None
-        for k, v in payload.items():
-            if isinstance(v, list):
-                data_key = k
-                break
-        rows = payload.get(data_key, [])
-        if total_count is None:
-            md = payload.get("metadata", {})
-            total_count = md.get("count", 0)
-        if not rows:
-            break
-        records.extend(rows)
-        skip += top
-        if progress and total_count:
-            progress.progress(min(1.0, len(records)/max(total_count,1)))
-        if len(rows) < top:
-            break
-    df = pd.DataFrame.from_records(records)
+
+    def fetch_page(url: str) -> Dict[str, Any]:
+        resp = session.get(url, timeout=60)
+        check(resp)
+        return orjson.loads(resp.content)
+
+    def stream_rows(url: str, data_key: str) -> List[Dict[str, Any]]:
+        # Parses the body as it arrives so only the record list is held, not the
+        # raw bytes plus the whole decoded payload, while pages run concurrently.
+        with session.get(url, timeout=60, stream=True) as resp:
+            check(resp)
+            resp.raw.decode_content = True
+            return list(ijson.items(resp.raw, f"{data_key}.item", use_float=True))
+
+    # The first page tells us the total count, so the remaining $skip offsets
+    # are known up front and can be fetched concurrently.
+    last_url = page_url(0)
+    payload = fetch_page(last_url)
+    # The records array key (PublicAssistanceGrantAwardActivities) is the same on every page.
+    data_key = next((k for k, v in payload.items() if isinstance(v, list)), None)
+    rows = payload[data_key] if data_key else []
+    total_count = payload.get("metadata", {}).get("count", 0)
+    pages = {0: rows}
+    skips = range(top, total_count, top)
+    if len(rows) == top and skips:
+        last_url = page_url(skips[-1])
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            futures = {pool.submit(stream_rows, page_url(skip), data_key): skip for skip in skips}
+            try:
+                for fut in as_completed(futures):
+                    pages[futures[fut]] = fut.result()
+            except Exception:
+                for fut in futures:
+                    fut.cancel()
+                raise
+    records = [r for skip in sorted(pages) for r in pages[skip]]
+    if select_fields:
+        # $select fixes the column set, so build columns directly instead of row by row.
+        df = pd.DataFrame({f: [r.get(f) for r in records] for f in select_fields}, copy=False)
+    else:
+        df = pd.DataFrame.from_records(records)
+    try:
+        # Arrow-backed strings let str.contains run on Arrow's string kernels.
+        for c in ("applicantName", "projectTitle"):
+            if c in df:
+                df[c] = df[c].astype("string[pyarrow]")
+    except ImportError:
+        pass
+    # Cast once on the full frame so summarize can aggregate the native dtypes directly.
+    if "federalShareObligated" in df:
+        df["federalShareObligated"] = pd.to_numeric(df["federalShareObligated"], errors="coerce").fillna(0.0)
+    if "dateObligated" in df:
+        df["dateObligated"] = pd.to_datetime(df["dateObligated"], errors="coerce")
+    # Low-cardinality codes: categorical groups on integer codes and uses far less memory.
+    for c in ("stateAbbreviation", "damageCategoryCode"):
+        if c in df:
+            df[c] = df[c].astype("category")
     return df, last_url, total_count or 0
 
-def is_water_utility(row: pd.Series, include: List[str], exclude: List[str]) -> bool:
-    name = str(row.get("applicantName") or "").lower()
-    title = str(row.get("projectTitle") or "").lower()
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_all_cached(filters: str, select_fields: Tuple[str, ...]) -> Tuple[pd.DataFrame, str, int]:
+    # Cached per (filter, fields) for an hour.
+    return fetch_all(filters, select_fields=list(select_fields))
+
+def _lower_text(col: pd.Series) -> pd.Series:
+    # Keep an existing string dtype (e.g. string[pyarrow]) rather than converting back to python storage.
+    if not isinstance(col.dtype, pd.StringDtype):
+        col = col.astype("string")
+    return col.str.lower().fillna("")
+
+def _keyword_pattern(keywords: List[str]) -> str:
+    return "|".join(map(re.escape, _collapse_keywords(keywords)))
+
+def water_utility_mask(df: pd.DataFrame, include: List[str], exclude: List[str]) -> pd.Series:
+    if not include:
+        return pd.Series(False, index=df.index)
+    name = _lower_text(df["applicantName"])
+    title = _lower_text(df["projectTitle"])
+    inc_pat = _keyword_pattern(include)
+    mask = (name + " " + title).str.contains(inc_pat, regex=True, na=False)
+    if exclude:
+        exc_pat = _keyword_pattern(exclude)
+        mask &= ~name.str.contains(exc_pat, regex=True, na=False)
+    return mask.astype(bool)
+
+def is_water_utility_tup(name: Any, title: Any, include: List[str], exclude: List[str]) -> bool:
+    name = name.lower() if isinstance(name, str) else ""
+    title = title.lower() if isinstance(title, str) else ""
     if any(x in name for x in exclude):
         return False
     text = f"{name} {title}"
     return any(x in text for x in include)
 
-def summarize(df: pd.DataFrame, include: List[str], exclude: List[str]) -> pd.DataFrame:
-    if df.empty:
-        return df
-    mask = df.apply(lambda r: is_water_utility(r, include, exclude), axis=1)
-    sdf = df.loc[mask].copy()
-    sdf["federalShareObligated"] = pd.to_numeric(sdf["federalShareObligated"], errors="coerce").fillna(0.0)
-    sdf["dateObligated"] = pd.to_datetime(sdf["dateObligated"], errors="coerce")
-    grp = sdf.groupby(["stateAbbreviation","applicantId","applicantName"], dropna=False).agg(
-        projectCount=("applicantId","count"),
+def predicate_mask(df: pd.DataFrame, include: List[str], exclude: List[str]) -> pd.Series:
+    # Slow path for row logic the vectorized mask can't express; only used when the
+    # "custom predicate" toggle is on. itertuples yields plain tuples, unlike
+    # apply(axis=1), which builds a Series per row.
+    rows = df[["applicantName","projectTitle"]].itertuples(index=False, name=None)
+    flags = np.fromiter((is_water_utility_tup(n, t, include, exclude) for n, t in rows),
+                        dtype=bool, count=len(df))
+    return pd.Series(flags, index=df.index)
+
+def summarize(water_df: pd.DataFrame) -> pd.DataFrame:
+    grp = water_df.groupby(["stateAbbreviation","applicantId","applicantName"], dropna=False, sort=False,
+                           observed=True, as_index=False).agg(
+        projectCount=("applicantId","size"),
         totalFederalShareObligated=("federalShareObligated","sum"),
         firstDateObligated=("dateObligated","min"),
         lastDateObligated=("dateObligated","max")
-    ).reset_index().rename(columns={"stateAbbreviation":"state"})
-    grp = grp.sort_values(["state","totalFederalShareObligated"], ascending=[True, False])
-    grp["firstDateObligated"] = grp["firstDateObligated"].dt.date.astype(str)
-    grp["lastDateObligated"] = grp["lastDateObligated"].dt.date.astype(str)
+    ).rename(columns={"stateAbbreviation":"state"})
+    # Group keys are left unsorted above; this is the only ordering pass.
+    grp = grp.sort_values(["state","totalFederalShareObligated"], ascending=[True, False], kind="stable")
+    # strftime leaves NaT as missing; fill it to keep the previous "NaT" text.
+    for c in ("firstDateObligated", "lastDateObligated"):
+        grp[c] = grp[c].dt.strftime("%Y-%m-%d").fillna("NaT")
     return grp
 
+@st.cache_data(ttl=3600, max_entries=16, show_spinner=False)
+def df_to_csv_bytes(df: pd.DataFrame) -> bytes:
+    return df.to_csv(index=False).encode("utf-8")
+
 st.set_page_config(page_title="FEMA → Water Utility Funding (Wildfire)", layout="wide")
 st.title("FEMA PA (v2) – Wildfire Funding Finder for Water Utilities")
 
@@ -132,52 +242,57 @@ with st.sidebar:
     incident_contains = st.toggle("Match incidentType by contains('Fire'/'Wildfire')", value=True)
     include = st.text_area("Include keywords (comma-separated)", value=",".join(DEFAULT_INCLUDE))
     exclude = st.text_area("Exclude keywords (comma-separated)", value=",".join(DEFAULT_EXCLUDE))
+    custom_predicate = st.toggle("Use custom row predicate (slow)", value=False)
     run = st.button("Run search", type="primary")
 
+# Sent as $select: only the columns the app uses, so pages are much smaller than the full schema.
 select_fields = [
     "stateAbbreviation","applicantId","applicantName","dateObligated","federalShareObligated",
     "projectTitle","pwNumber","versionNumber","disasterNumber","county","damageCategoryCode","incidentType"
 ]
 
 if run:
-    states = [s.strip().upper() for s in states_input.split(",") if s.strip()] if states_input else None
+    states = tuple(s.strip().upper() for s in states_input.split(",") if s.strip())
+    categories = tuple(c.strip().upper() for c in cats if c.strip())
     s = start_date.isoformat() if start_date else None
     e = end_date.isoformat() if end_date else None
-    flt = build_filter(states, s, e, cats, incident_contains)
+    include_list = [x.strip().lower() for x in include.split(",") if x.strip()]
+    exclude_list = [x.strip().lower() for x in exclude.split(",") if x.strip()]
+    flt = build_filter(states, s, e, categories, incident_contains, include_list)
     st.caption(f"API filter: `{flt}`")
-    progress = st.progress(0.0)
     try:
-        df, last_url, total_count = fetch_all(flt, select_fields=select_fields, progress=progress)
-        progress.progress(1.0)
+        with st.spinner("Fetching records from OpenFEMA..."):
+            df, last_url, total_count = fetch_all_cached(flt, tuple(select_fields))
         st.caption(f"Records found (API count): {total_count} | Last page URL used (copy into browser to debug):")
         st.code(last_url, language="text")
     except Exception as ex:
         st.error(f"API error: {ex}")
         st.stop()
 
-    include_list = [x.strip().lower() for x in include.split(",") if x.strip()]
-    exclude_list = [x.strip().lower() for x in exclude.split(",") if x.strip()]
-
     if df.empty:
         st.warning("No results. Tips: remove state/date filters; include more categories (B/E often have wildfire water costs); use 'contains' for incidentType.")
         st.stop()
 
     st.subheader("Detailed results (project-level) – filtered to water utilities")
-    mask = df.apply(lambda r: is_water_utility(r, include_list, exclude_list), axis=1)
-    water_df = df.loc[mask].copy()
+    if custom_predicate:
+        mask = predicate_mask(df, include_list, exclude_list)
+    else:
+        mask = water_utility_mask(df, include_list, exclude_list)
+    water_df = df.loc[mask]
     st.write(f"Matched **{len(water_df)}** water-utility project rows out of **{len(df)}** API rows.")
-    st.dataframe(water_df.head(100))
-    st.download_button("Download detailed CSV", water_df.to_csv(index=False).encode("utf-8"),
+    AgGrid(water_df.head(100).copy(), update_mode=GridUpdateMode.NO_UPDATE, key="water_grid")
+    st.download_button("Download detailed CSV", df_to_csv_bytes(water_df),
                        file_name="fema_water_pa_fire_detailed.csv", mime="text/csv")
 
     st.subheader("Summary by utility")
-    sum_df = summarize(df, include_list, exclude_list)
-    st.dataframe(sum_df.head(100))
-    st.download_button("Download summary CSV", sum_df.to_csv(index=False).encode("utf-8"),
+    sum_df = summarize(water_df)
+    AgGrid(sum_df.head(100).copy(), update_mode=GridUpdateMode.NO_UPDATE, key="summary_grid")
+    st.download_button("Download summary CSV", df_to_csv_bytes(sum_df),
                        file_name="fema_water_pa_fire_summary.csv", mime="text/csv")
 
     st.subheader("Top utilities by total federal share (net)")
-    toplist = sum_df.sort_values("totalFederalShareObligated", ascending=False).head(20)
+    # Partial selection of the top 20; sum_df keeps its (state, total) order for the table/CSV above.
+    toplist = sum_df.nlargest(20, "totalFederalShareObligated")
     st.table(toplist[["state","applicantName","projectCount","totalFederalShareObligated","firstDateObligated","lastDateObligated"]])
 
 st.markdown("""---